@@ -1,9 +1,23 @@
 from abc import ABC, abstractmethod
 
+from text_analytics import concurrency
+
 
 class NLPService(ABC):
 
+    # Implementations hold concurrency.nlp_request_slots while calling the NLP service
     @abstractmethod
     def process(self, text):
         return None
 
+    def process_batch(self, texts):
+        '''
+        Processes each of the texts, and returns the NLP outputs in the same order.
+
+        The NLP services take one text per request, so the requests are run concurrently on a shared executor.
+        Each request still holds one of the nlp_request_slots, so batches never exceed max_nlp_requests.
+        A service with a batch endpoint can override this to send the texts in one request.
+        '''
+        if len(texts) <= 1:
+            return [self.process(text) for text in texts]
+        return list(concurrency.batch_executor.map(self.process, texts))
@@ -1,17 +1,17 @@
 import json
 import logging
-import os
+import re
+import threading
 
 from fhir.resources.codeableconcept import CodeableConcept
 from fhir.resources.dosage import Dosage, DosageDoseAndRate
-from fhir.resources.extension import Extension
-from fhir.resources.medicationstatement import MedicationStatement
 from fhir.resources.quantity import Quantity
 from fhir.resources.timing import Timing
 from ibm_cloud_sdk_core.authenticators.iam_authenticator import IAMAuthenticator
 from ibm_whcs_sdk import annotator_for_clinical_data as acd
 
 from text_analytics.abstract_nlp_service import NLPService
+from text_analytics.concurrency import nlp_request_slots
 from text_analytics.enhance import *
 from text_analytics.insights import insight_constants
 from text_analytics.insights.add_insights_medication import create_insight
@@ -20,6 +20,16 @@ from text_analytics.utils import fhir_object_utils
 
 logger = logging.getLogger()
 
+# Whole dose value: an amount, optionally with thousands separators or a leading decimal point,
+# followed by optional units that are the rest of the value, for example "1,000 mg", ".5 mg" or "325 mg tablet".
+# Units must start with a letter and not be a product, so "5-10 mg", "1/2 tablet" and "2 x 5 mg" do not match.
+DOSE_PATTERN = re.compile(r'\s*((?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?|\.\d+)\s*((?![xX]\s*\d)[A-Za-z].*?)?\s*')
+
+# ACD frequency values mapped to (code, display) in the timing abbreviation value set
+FREQUENCY_TIMING_CODES = {'Q AM': ('AM', 'AM'), 'Q AM.': ('AM', 'AM'), 'AM': ('AM', 'AM'),
+                          'Q PM': ('PM', 'PM'), 'Q PM.': ('PM', 'PM'), 'PM': ('PM', 'PM')}
+
+
 class ACDService(NLPService):
     types_can_handle = {'AllergyIntolerance': enhance_allergy_intolerance_payload_to_fhir,
                         'Immunization': enhance_immunization_payload_to_fhir,
@@ -39,32 +49,43 @@ class ACDService(NLPService):
         self.acd_flow = config_dict["config"]["flow"]
         self.config_name = config_dict["name"]
         self.jsonString = json_string
-        config_dict = json.loads(json_string)
-        if config_dict.get('version') is not None:
-            self.version = config_dict.get('version')
+        version = config_dict.get('version')
+        if version is not None:
+            self.version = version
+        # The SDK client and its IAM authenticator are not documented as thread-safe, and resources are
+        # processed on several threads, so each thread keeps its own client for this config
+        self._clients = threading.local()
+
+    def _get_service(self):
+        # The client (and authenticator) is reused across calls on a thread, so the IAM token is reused until it expires
+        service = getattr(self._clients, 'service', None)
+        if service is None:
+            service = acd.AnnotatorForClinicalDataV1(
+                authenticator=IAMAuthenticator(apikey=self.acd_key),
+                version=self.version
+            )
+            service.set_service_url(self.acd_url)
+            self._clients.service = service
+        return service
 
     def process(self, text):
-        service = acd.AnnotatorForClinicalDataV1(
-            authenticator=IAMAuthenticator(apikey=self.acd_key),
-            version=self.version
-        )
-        service.set_service_url(self.acd_url)
-        logger.info("Calling ACD-" + self.config_name)
-        resp = service.analyze_with_flow(self.acd_flow, text)
+        logger.info("Calling ACD-%s", self.config_name)
+        service = self._get_service()
+        with nlp_request_slots:
+            resp = service.analyze_with_flow(self.acd_flow, text)
         out = resp.to_dict()
         return out
 
-    def add_medications(self, nlp, diagnostic_report, nlp_output, med_statements_found, med_statements_insight_counter):
+    def add_medications(self, nlp, diagnostic_report, nlp_output, get_insight_detail):
         medications = nlp_output.get('MedicationInd', [])
-        med_statements_found = {}
-        med_statements_insight_counter = {}
+        med_statements_tracker = {}
         for medication in medications:
-            med_statements_found, med_statements_insight_counter = create_insight(medication, nlp, nlp_output, diagnostic_report, ACDService.build_medication, med_statements_found, med_statements_insight_counter)
+            create_insight(medication, nlp, get_insight_detail, diagnostic_report, ACDService.build_medication, med_statements_tracker)
 
-        return med_statements_found, med_statements_insight_counter
+        return med_statements_tracker
 
     @staticmethod
-    def build_medication(med_statement, medication, insight_id):
+    def build_medication(med_statement, medication, insight_id, coding_index=None):
         if med_statement.status is None:
             med_statement.status = 'unknown'
 
@@ -72,38 +93,26 @@ class ACDService(NLPService):
         acd_drug_name = acd_drug.get("drugSurfaceForm")
 
 
-        if type(med_statement.medicationCodeableConcept) is dict and med_statement.medicationCodeableConcept.get("text") == "template":
-            codeable_concept = CodeableConcept.construct()
-            codeable_concept.text = acd_drug_name
-            med_statement.medicationCodeableConcept = codeable_concept
-            codeable_concept.coding = []
+        if med_statement.medicationCodeableConcept is None:
+            med_statement.medicationCodeableConcept = CodeableConcept.construct(text=acd_drug_name, coding=[])
 
-        fhir_object_utils.add_codings_drug(acd_drug, acd_drug_name, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
+        fhir_object_utils.add_codings_drug(acd_drug, acd_drug_name, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM,
+                                           coding_index)
 
-        if hasattr(medication, "administration"):
-            if med_statement.dosage is None:
-                med_statement.dosage = []
+        administration = medication.get('administration')
+        if administration:
             dose = Dosage.construct()
             dose_rate = DosageDoseAndRate.construct()
-            dose_with_units = medication.get('administration')[0].get("dosageValue")
+            dose_with_units = administration[0].get("dosageValue")
             if dose_with_units is not None:
                 dose_amount = None
                 dose_units = None
-                if ' ' in dose_with_units:
-                    dose_info = dose_with_units.split(' ')
-                    amount = dose_info[0].replace(',','')
-                    try:
-                        dose_amount = float(amount)
-                    except OverflowError:
-                        logger.exception("Error with dose amount overflow")
-                    if isinstance(dose_info[1], str):
-                        dose_units = dose_info[1]
+                dose_match = DOSE_PATTERN.fullmatch(dose_with_units)
+                if dose_match is not None:
+                    dose_amount = float(dose_match.group(1).replace(',', ''))
+                    dose_units = dose_match.group(2)
                 else:
-                    amount = dose_with_units.replace(',','')
-                    try:
-                        dose_amount = float(amount)
-                    except OverflowError:
-                        logger.exception("Error with dose amount overflow")
+                    logger.info("Dose value is not a single amount with units, skipping: %s", dose_with_units)
 
                 if dose_amount is not None:
                     dose_quantity = Quantity.construct()
@@ -113,25 +122,20 @@ class ACDService(NLPService):
                     dose_rate.doseQuantity = dose_quantity
                     dose.doseAndRate = [dose_rate]
 
-            frequency = medication.get('administration')[0].get("frequencyValue")
-            if frequency is not None:
-                code = None
-                display = None
-
-                if frequency in ['Q AM', 'Q AM.', 'AM']:
-                    code = 'AM'
-                    display = 'AM'
-                elif frequency in ['Q PM', 'Q PM.', 'PM']:
-                    code = 'PM'
-                    display = 'PM'
-
-                if code is not None and display is not None:
-                    timing = Timing.construct()
-                    timing_codeable_concept = CodeableConcept.construct()
-                    timing_codeable_concept.coding = [fhir_object_utils.create_coding(insight_constants.TIMING_URL, code, display)]
-                    timing_codeable_concept.text = frequency
-                    timing.code = timing_codeable_concept
-                    dose.timing = timing
-
-            dose.extension = [fhir_object_utils.create_insight_reference(insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)]
-            med_statement.dosage.append(dose)
+            frequency = administration[0].get("frequencyValue")
+            timing_code = FREQUENCY_TIMING_CODES.get(frequency)
+            if timing_code is not None:
+                code, display = timing_code
+                timing = Timing.construct()
+                timing_codeable_concept = CodeableConcept.construct()
+                timing_codeable_concept.coding = [fhir_object_utils.create_coding(insight_constants.TIMING_URL, code, display)]
+                timing_codeable_concept.text = frequency
+                timing.code = timing_codeable_concept
+                dose.timing = timing
+
+            # only add the dose when there is a dose amount or timing to record
+            if dose.doseAndRate is not None or dose.timing is not None:
+                dose.extension = [fhir_object_utils.create_insight_reference(insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)]
+                if med_statement.dosage is None:
+                    med_statement.dosage = []
+                med_statement.dosage.append(dose)
@@ -1,9 +1,11 @@
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Flask, request, Response
 
+from text_analytics.concurrency import max_nlp_requests
 from text_analytics.acd.acd_service import ACDService
 from text_analytics.quickUMLS.quickUMLS_service import QuickUMLSService
 
@@ -20,6 +22,11 @@ nlp_service = None
 nlp_services_dict = {}
 # Stores resource to config overrides
 override_resource_config = {}
+# Number of bundle entries processed concurrently, so NLP calls overlap with building insights
+# Set with NLP_RESOURCE_WORKERS, which also limits the requests sent to the NLP service at once
+max_resource_workers = max_nlp_requests
+# Shared by all requests, so each bundle does not start threads of its own
+resource_executor = ThreadPoolExecutor(max_workers=max_resource_workers, thread_name_prefix="resource")
 
 
 def setup_config_dir():
@@ -69,9 +76,9 @@ def init_configs():
             details["flow"] = os.getenv("ACD_FLOW")
             tmp_config["config"] = details
             persist_config_helper(tmp_config)
-            logger.info("%s added:%s", tmp_config["name"], str(nlp_services_dict))
+            logger.info("%s added:%s", tmp_config["name"], nlp_services_dict)
         except Exception as ex:
-            logger.exception("Error when trying to persist initial config...skipping:%s", str(ex))
+            logger.exception("Error when trying to persist initial config...skipping:%s", ex)
 
     if os.getenv("QUICKUMLS_ENABLE_CONFIG") == 'true':
         # fill up a config for quickumls
@@ -83,9 +90,9 @@ def init_configs():
             details["endpoint"] = os.getenv("QUICKUMLS_ENDPOINT")
             tmp_config["config"] = details
             persist_config_helper(tmp_config)
-            logger.info("%s added:%s", tmp_config["name"], str(nlp_services_dict))
+            logger.info("%s added:%s", tmp_config["name"], nlp_services_dict)
         except Exception as ex:
-            logger.exception("Error when trying to persist initial config...skipping:%s", str(ex))
+            logger.exception("Error when trying to persist initial config...skipping:%s", ex)
 
     default_nlp_service = os.getenv("NLP_SERVICE_DEFAULT")
     if default_nlp_service is not None and len(default_nlp_service) > 0:
@@ -124,7 +131,7 @@ def persist_config():
         request_str = request.data.decode('utf-8')
         config_dict = json.loads(request_str)
         config_name = persist_config_helper(config_dict)
-        logger.info("%s added:%s", config_name, str(nlp_services_dict))
+        logger.info("%s added:%s", config_name, nlp_services_dict)
     except Exception as ex:
         logger.exception("Error when trying to persist given config.")
         return Response("Error when trying to persist given config-" + str(ex), status=400)
@@ -149,7 +156,7 @@ def delete_config(config_name):
     except Exception as ex:
         logger.exception("Error when trying to delete config")
         return Response("Error when trying to delete config-" + str(ex), status=400)
-    logger.info("Config successfully deleted: " + config_name)
+    logger.info("Config successfully deleted: %s", config_name)
     return Response("Config successfully deleted: " + config_name, status=200)
 
 
@@ -266,15 +273,22 @@ def discover_insights():
     new_entries = []
     if input_type == 'Bundle':
         entrylist = fhir_data['entry']
-        for entry in entrylist:
-            if entry["resource"]["resourceType"] in nlp_service.types_can_handle:
-                resp = process_resource(entry["resource"])
-                if resp['resourceType'] == 'Bundle':
-                    # response is a bundle of new resources to keep for later
-                    for new_entry in resp['entry']:
-                        new_entries.append(new_entry)  # keep new resources to be added later
-                else:
-                    entry["resource"] = resp  # update existing resource
+        entries_to_process = [entry for entry in entrylist
+                              if entry["resource"]["resourceType"] in nlp_service.types_can_handle]
+        resources = [entry["resource"] for entry in entries_to_process]
+        if len(resources) < 2:
+            responses = [process_resource(resource) for resource in resources]
+        else:
+            # results are returned in entry order while later entries are still being processed;
+            # if an entry fails, entries that have not started yet are cancelled
+            responses = resource_executor.map(process_resource, resources)
+        for entry, resp in zip(entries_to_process, responses):
+            if resp['resourceType'] == 'Bundle':
+                # response is a bundle of new resources to keep for later
+                for new_entry in resp['entry']:
+                    new_entries.append(new_entry)  # keep new resources to be added later
+            else:
+                entry["resource"] = resp  # update existing resource
 
         for new_entry in new_entries:
             entrylist.append(new_entry)  # add new resources to bundle
@@ -290,25 +304,23 @@ def discover_insights():
 
 def process_resource(request_data):
     """Generate insights for a single resource"""
-    global nlp_service
     resource_type = request_data['resourceType']
     logger.info("Processing resource type: %s", resource_type)
-    nlp_service_backup = nlp_service  # save original to reset later
+    # the override is kept local so resources can be processed concurrently
+    resource_nlp_service = nlp_service
     if resource_type in override_resource_config:
-        nlp_service = nlp_services_dict[override_resource_config[resource_type]]
+        resource_nlp_service = nlp_services_dict[override_resource_config[resource_type]]
         logger.info("NLP engine override for %s using %s", resource_type, override_resource_config[resource_type])
 
-    if resource_type in nlp_service.types_can_handle:
-        enhance_func = nlp_service.types_can_handle[resource_type]
-        resp = enhance_func(nlp_service, request_data)
+    if resource_type in resource_nlp_service.types_can_handle:
+        enhance_func = resource_nlp_service.types_can_handle[resource_type]
+        resp = enhance_func(resource_nlp_service, request_data)
         json_response = json.loads(resp)
 
         logger.info("Resource successfully updated")
-        nlp_service = nlp_service_backup
         return json_response
     else:
         logger.info("Resource not handled so respond back with original")
-        nlp_service = nlp_service_backup
         return request_data
 
 
@@ -0,0 +1,31 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+
+def _worker_count_from_env(name, default):
+    """Read a worker count from the environment, using the default if it is unset, not a number or below 1"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        logger.warning("%s must be a number of at least 1, using %s instead of: %s", name, default, value)
+        return default
+    return workers
+
+
+# Maximum number of requests sent to the NLP services at once, across the whole process.
+# This covers bundles, batches and single resources alike.
+# Can be set with NLP_RESOURCE_WORKERS, for example to match the concurrency the NLP service allows
+max_nlp_requests = _worker_count_from_env("NLP_RESOURCE_WORKERS", 4)
+# Held by each request to an NLP service while it is in flight
+nlp_request_slots = threading.BoundedSemaphore(max_nlp_requests)
+# Shared by all NLPService.process_batch calls, so a batch does not start threads of its own
+batch_executor = ThreadPoolExecutor(max_workers=max_nlp_requests, thread_name_prefix="nlp-batch")
@@ -15,20 +15,21 @@ def enhance_allergy_intolerance_payload_to_fhir(nlp, input_json):
     """
 
     allergy_intolerance_fhir = AllergyIntolerance.parse_obj(input_json)
-    nlp_results = []
+    fields_to_process = []  # (codeable concept, text) pairs
 
     if allergy_intolerance_fhir.code and allergy_intolerance_fhir.code.text:
         text = adjust_allergy_text(allergy_intolerance_fhir.code.text)
-        nlp_resp = nlp.process(text)
-        nlp_results.append([allergy_intolerance_fhir.code, nlp_resp])
+        fields_to_process.append((allergy_intolerance_fhir.code, text))
 
-    if allergy_intolerance_fhir.reaction:
-        for reaction in allergy_intolerance_fhir.reaction:
-            for mf in reaction.manifestation:
-                nlp_resp = nlp.process(mf.text)
-                nlp_results.append([mf, nlp_resp])
+    for reaction in allergy_intolerance_fhir.reaction or ():
+        for mf in reaction.manifestation:
+            fields_to_process.append((mf, mf.text))
 
-    if nlp_results:
+    result_allergy = None
+    if fields_to_process:
+        nlp_responses = nlp.process_batch([text for _, text in fields_to_process])
+        nlp_results = [(codeable_concept, nlp_resp) for (codeable_concept, _), nlp_resp
+                       in zip(fields_to_process, nlp_responses)]
         result_allergy = update_allergy_with_insights(nlp, allergy_intolerance_fhir, nlp_results)
 
     return result_allergy.json() if result_allergy else allergy_intolerance_fhir.json()
@@ -19,17 +19,20 @@ def enhance_document_reference_payload_to_fhir(nlp, document_reference_json):
     text = fhir_object_utils.get_document_reference_data(document_reference_fhir)
     if text:
         nlp_resp = nlp.process(text)
-        create_conditions_fhir = create_conditions_from_insights(nlp, document_reference_fhir, nlp_resp)
-        create_med_statements_fhir = create_med_statements_from_insights(nlp, document_reference_fhir, nlp_resp)
+        # the nlp output is encoded at most once, when the first insight is built,
+        # and shared by every insight on the conditions and medication statements
+        get_insight_detail = fhir_object_utils.insight_detail_builder(nlp_resp)
+        create_conditions_fhir = create_conditions_from_insights(nlp, document_reference_fhir, nlp_resp, get_insight_detail)
+        create_med_statements_fhir = create_med_statements_from_insights(nlp, document_reference_fhir, nlp_resp, get_insight_detail)
 
         if create_conditions_fhir:
             for condition in create_conditions_fhir:
-                bundle_entry = [condition, 'POST', condition.resource_type]
+                bundle_entry = (condition, 'POST', condition.resource_type)
                 bundle_entries.append(bundle_entry)
 
         if create_med_statements_fhir:
             for med_statement in create_med_statements_fhir:
-                bundle_entry = [med_statement, 'POST', med_statement.resource_type]
+                bundle_entry = (med_statement, 'POST', med_statement.resource_type)
                 bundle_entries.append(bundle_entry)
 
     bundle = fhir_object_utils.create_transaction_bundle(bundle_entries)
@@ -5,28 +5,29 @@ from text_analytics.utils import fhir_object_utils
 
 def update_allergy_with_insights(nlp, allergy, nlp_results):
     insight_num = 0
+    result_extension = None  # set up with the resource meta when the first insight is added
     for codeable_concept, nlp_response in nlp_results:
-        concepts = nlp_response["concepts"]
-        if concepts is not None:
-            for concept in concepts:
-                the_type = concept['type']
-                if isinstance(the_type, str):
-                    the_type = [the_type]
-                if len(set(the_type) & set(["umls.DiseaseOrSyndrome", "umls.PathologicFunction", "umls.SignOrSymptom"])) > 0:
-                    insight_num = insight_num + 1
-                    insight_id = "insight-" + str(insight_num)
+        concepts = nlp_response.get("concepts")
+        if not concepts:
+            continue
+        insight_detail = None  # insight detail extension, shared by the insights from this response
+        for concept in concepts:
+            if insight_constants.concept_type_matches(concept['type'], insight_constants.CONCEPT_TYPES_ALLERGY):
+                insight_num = insight_num + 1
+                insight_id = f"insight-{insight_num}"
 
-                    if codeable_concept.coding is None:
-                        codeable_concept.coding = []
-                    fhir_object_utils.add_codings(concept, codeable_concept, insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
+                if codeable_concept.coding is None:
+                    codeable_concept.coding = []
+                fhir_object_utils.add_codings(concept, codeable_concept, insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
 
-                    insight = Extension.construct()
-                    insight.url = insight_constants.INSIGHT_INSIGHT_ENTRY_URL
-                    insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
-                    insight.extension = [insight_id_ext]
-                    insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_response)
-                    insight.extension.append(insight_detail)
+                insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
+                if insight_detail is None:
+                    insight_detail = fhir_object_utils.create_insight_detail_extension(
+                        fhir_object_utils.encode_insight_detail(nlp_response))
+                insight = Extension.construct(url=insight_constants.INSIGHT_INSIGHT_ENTRY_URL,
+                                              extension=[insight_id_ext, insight_detail])
 
+                if result_extension is None:
                     fhir_object_utils.add_resource_meta_structured(nlp, allergy)
                     if allergy.meta.extension is None:
                         ext = Extension.construct()
@@ -35,7 +36,7 @@ def update_allergy_with_insights(nlp, allergy, nlp_results):
                     result_extension = allergy.meta.extension[0]
                     if result_extension.extension is None:
                         result_extension.extension = []
-                    result_extension.extension.append(insight)
+                result_extension.extension.append(insight)
 
     if insight_num == 0:
         return None
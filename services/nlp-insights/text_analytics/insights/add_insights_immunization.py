@@ -15,34 +15,32 @@ Returns the updated resource if any insights were added to it.  Returns None if
 """
 def update_immunization_with_insights(nlp, immunization, nlp_results):
     insight_num = 0
-    concepts = nlp_results["concepts"]
-    if concepts is not None:
-        for concept in concepts:
-            the_type = concept['type']
-            if isinstance(the_type, str):
-                the_type = [the_type]
-            if len(set(the_type) & set(["ICMedication", "umls.ImmunologicFactor"])) > 0:
-                # Add a new insight
-                insight_num = insight_num + 1
-                insight_id = "insight-" + str(insight_num)
+    concepts = nlp_results.get("concepts")
+    if not concepts:  # No insights possible
+        return None
+    insight_detail = None  # insight detail extension, shared by all insights
+    result_extension = None  # set up with the resource meta when the first insight is added
+    for concept in concepts:
+        if insight_constants.concept_type_matches(concept['type'], insight_constants.CONCEPT_TYPES_IMMUNIZATION):
+            # Add a new insight
+            insight_num = insight_num + 1
+            insight_id = f"insight-{insight_num}"
 
-                if immunization.vaccineCode is None:
-                    codeable_concept = CodeableConcept.construct()
-                    codeable_concept.text = concept["preferredName"]
-                    immunization.vaccineCode = codeable_concept
-                    codeable_concept.coding = []
-                fhir_object_utils.add_codings(concept, immunization.vaccineCode, insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
+            if immunization.vaccineCode is None:
+                immunization.vaccineCode = CodeableConcept.construct(text=concept["preferredName"], coding=[])
+            fhir_object_utils.add_codings(concept, immunization.vaccineCode, insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
 
-                # Create insight for resource level extension
-                insight = Extension.construct()
-                insight.url = insight_constants.INSIGHT_INSIGHT_ENTRY_URL
-                insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
-                insight.extension = [insight_id_ext]
-                # Save ACD response
-                insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_results)
-                insight.extension.append(insight_detail)
+            # Create insight for resource level extension
+            insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
+            # Save ACD response
+            if insight_detail is None:
+                insight_detail = fhir_object_utils.create_insight_detail_extension(
+                    fhir_object_utils.encode_insight_detail(nlp_results))
+            insight = Extension.construct(url=insight_constants.INSIGHT_INSIGHT_ENTRY_URL,
+                                          extension=[insight_id_ext, insight_detail])
 
-                # Add meta if any insights were added
+            # Add meta if any insights were added
+            if result_extension is None:
                 fhir_object_utils.add_resource_meta_structured(nlp, immunization)
                 if immunization.meta.extension is None:
                     ext = Extension.construct()
@@ -51,7 +49,7 @@ def update_immunization_with_insights(nlp, immunization, nlp_results):
                 result_extension = immunization.meta.extension[0]
                 if result_extension.extension is None:
                     result_extension.extension = []
-                result_extension.extension.append(insight)
+            result_extension.extension.append(insight)
 
     if insight_num == 0:  # No insights found
         return None
@@ -67,8 +65,5 @@ Parameters:
 '''
 def _build_resource_data(immunization, concept, insight_id):
     if immunization.vaccineCode is None:
-        codeable_concept = CodeableConcept.construct()
-        codeable_concept.text = concept["preferredName"]
-        immunization.vaccineCode = codeable_concept
-        codeable_concept.coding = []
+        immunization.vaccineCode = CodeableConcept.construct(text=concept["preferredName"], coding=[])
     fhir_object_utils.add_codings(concept, immunization.vaccineCode, insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
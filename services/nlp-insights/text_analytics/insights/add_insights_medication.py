@@ -1,94 +1,74 @@
 import logging
 
 from fhir.resources.codeableconcept import CodeableConcept
-from fhir.resources.dosage import Dosage, DosageDoseAndRate
 from fhir.resources.extension import Extension
 from fhir.resources.medicationstatement import MedicationStatement
-from fhir.resources.quantity import Quantity
-from fhir.resources.timing import Timing
 from text_analytics.insights import insight_constants
 from text_analytics.utils import fhir_object_utils
 
 logger = logging.getLogger()
 
 def _create_med_statement_from_template():
-
-    med_statement_template = {
-        "status": "unknown",
-        "medicationCodeableConcept": {
-
-            "text": "template"
-        }
-    }
-    med_statement = MedicationStatement.construct(**med_statement_template)
+    # medicationCodeableConcept is filled in by the first insight built for the statement
+    med_statement = MedicationStatement.construct(status="unknown")
     return med_statement
 
 
-def _build_resource(nlp, diagnostic_report, nlp_output):
+def _build_resource(nlp, diagnostic_report, nlp_output, get_insight_detail):
     concepts = nlp_output.get('concepts')
-    med_statements_found = {}            # key is UMLS ID, value is the FHIR resource
-    med_statements_insight_counter = {}  # key is UMLS ID, value is the current insight_num
+    med_statements_tracker = {}  # key is UMLS ID, value is [FHIR resource, current insight_num, coding index]
 
     if hasattr(nlp, 'add_medications'):
-        med_statements_found, med_statements_insight_counter = nlp.add_medications(nlp, diagnostic_report, nlp_output, med_statements_found, med_statements_insight_counter)
+        med_statements_tracker = nlp.add_medications(nlp, diagnostic_report, nlp_output, get_insight_detail)
 
-    for concept in concepts:
-        the_type = concept['type']
-        if isinstance(the_type, str):
-            the_type = [the_type]
-        if len(set(the_type) & set(['umls.Antibiotic', 'umls.ClinicalDrug', 'umls.PharmacologicSubstance', 'umls.OrganicChemical'])) > 0:
-            med_statements_found, med_statements_insight_counter = create_insight(concept, nlp, nlp_output, diagnostic_report, _build_resource_data, med_statements_found, med_statements_insight_counter)
+    for concept in concepts or ():
+        if insight_constants.concept_type_matches(concept['type'], insight_constants.CONCEPT_TYPES_MEDICATION):
+            create_insight(concept, nlp, get_insight_detail, diagnostic_report, _build_resource_data, med_statements_tracker)
 
-    if len(med_statements_found) == 0:
+    if len(med_statements_tracker) == 0:
         return None
-    return list(med_statements_found.values())
+    return [tracker_entry[0] for tracker_entry in med_statements_tracker.values()]
 
-def create_insight(concept, nlp, nlp_output, diagnostic_report, build_resource, med_statements_found, med_statements_insight_counter):
+# med_statements_tracker --> dict of UMLS ID to [FHIR resource, current insight_num, coding index], updated in place
+# The coding index (see fhir_object_utils.index_codings) is kept with the statement, so it is not rebuilt per insight
+# get_insight_detail --> returns the insight detail extension for the nlp output, see fhir_object_utils.insight_detail_builder
+def create_insight(concept, nlp, get_insight_detail, diagnostic_report, build_resource, med_statements_tracker):
     cui = concept.get('cui')
-    med_statement = med_statements_found.get(cui)
-    if med_statement is None:
+    tracker_entry = med_statements_tracker.get(cui)
+    if tracker_entry is None:
         med_statement = _create_med_statement_from_template()
         med_statement.meta = fhir_object_utils.add_resource_meta_unstructured(nlp, diagnostic_report)
-        med_statements_found[cui] = med_statement
-        insight_num = 1
-    else:
-        insight_num = med_statements_insight_counter[cui] + 1
-    med_statements_insight_counter[cui] = insight_num
-    insight_id = "insight-" + str(insight_num)
-    build_resource(med_statement, concept, insight_id)
-    insight = Extension.construct()
-    insight.url = insight_constants.INSIGHT_INSIGHT_ENTRY_URL
+        med_statement.subject = diagnostic_report.subject
+        fhir_object_utils.create_derived_resource_extension(med_statement)
+        tracker_entry = [med_statement, 0, {}]
+        med_statements_tracker[cui] = tracker_entry
+    med_statement = tracker_entry[0]
+    tracker_entry[1] += 1
+    insight_id = f"insight-{tracker_entry[1]}"
+    build_resource(med_statement, concept, insight_id, tracker_entry[2])
     insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
-    insight.extension = [insight_id_ext]
-    insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_output)
-    insight.extension.append(insight_detail)
     insight_span = fhir_object_utils.create_insight_span_extension(concept)
-    insight.extension.append(insight_span)
+    insight = Extension.construct(url=insight_constants.INSIGHT_INSIGHT_ENTRY_URL,
+                                  extension=[insight_id_ext, get_insight_detail(), insight_span])
     insight_model_data = concept.get('insightModelData')
     if insight_model_data is not None:
         fhir_object_utils.add_medication_confidences(insight.extension, insight_model_data)
     result_extension = med_statement.meta.extension[0]
     result_extension.extension.append(insight)
-    return med_statements_found, med_statements_insight_counter
 
-def _build_resource_data(med_statement, concept, insight_id):
+def _build_resource_data(med_statement, concept, insight_id, coding_index=None):
     if med_statement.status is None:
         med_statement.status = 'unknown'
 
     drug = concept.get('preferredName')
 
-    if type(med_statement.medicationCodeableConcept) is dict and med_statement.medicationCodeableConcept.get("text") == "template":
-        codeable_concept = CodeableConcept.construct()
-        codeable_concept.text = drug
-        med_statement.medicationCodeableConcept = codeable_concept
-        codeable_concept.coding = []
+    if med_statement.medicationCodeableConcept is None:
+        med_statement.medicationCodeableConcept = CodeableConcept.construct(text=drug, coding=[])
 
-    fhir_object_utils.add_codings_drug(concept, drug, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
+    fhir_object_utils.add_codings_drug(concept, drug, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM,
+                                       coding_index)
 
-def create_med_statements_from_insights(nlp, diagnostic_report, nlp_output):
-    med_statements = _build_resource(nlp, diagnostic_report, nlp_output)
-    if med_statements is not None:
-        for med_statement in med_statements:
-            med_statement.subject = diagnostic_report.subject
-            fhir_object_utils.create_derived_resource_extension(med_statement)
+# get_insight_detail --> returns the insight detail extension for the nlp output, see fhir_object_utils.insight_detail_builder
+def create_med_statements_from_insights(nlp, diagnostic_report, nlp_output, get_insight_detail):
+    med_statements = _build_resource(nlp, diagnostic_report, nlp_output, get_insight_detail)
     return med_statements
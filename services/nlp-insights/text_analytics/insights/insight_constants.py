@@ -60,3 +60,25 @@ CONFIDENCE_SCORE_MEDICATION_TAKEN = "Medication Taken Score"
 CONFIDENCE_SCORE_MEDICATION_CONSIDERING = "Medication Considering Score"
 CONFIDENCE_SCORE_MEDICATION_DISCUSSED = "Medication Discussed Score"
 CONFIDENCE_SCORE_MEDICATION_MEASUREMENT = "Medication Lab Measurement Score"
+
+# Concept types (UMLS semantic types and ACD annotation types) that produce an insight for each resource type
+CONCEPT_TYPES_ALLERGY = frozenset(("umls.DiseaseOrSyndrome", "umls.PathologicFunction", "umls.SignOrSymptom"))
+CONCEPT_TYPES_CONDITION = frozenset(("ICDiagnosis", "umls.DiseaseOrSyndrome", "umls.PathologicFunction",
+                                     "umls.SignOrSymptom", "umls.NeoplasticProcess", "umls.CellOrMolecularDysfunction",
+                                     "umls.MentalOrBehavioralDysfunction"))
+CONCEPT_TYPES_IMMUNIZATION = frozenset(("ICMedication", "umls.ImmunologicFactor"))
+CONCEPT_TYPES_MEDICATION = frozenset(("umls.Antibiotic", "umls.ClinicalDrug", "umls.PharmacologicSubstance",
+                                      "umls.OrganicChemical"))
+CONCEPT_TYPES_ANY = CONCEPT_TYPES_ALLERGY | CONCEPT_TYPES_CONDITION | CONCEPT_TYPES_IMMUNIZATION | CONCEPT_TYPES_MEDICATION
+
+
+def concept_type_matches(the_type, concept_types):
+    '''
+    Returns True if the type of an nlp concept is one of the concept_types (a frozenset).
+    The type may be a single string or a list of strings, or None if the concept has no type.
+    '''
+    if the_type is None:
+        return False
+    if isinstance(the_type, str):
+        return the_type in concept_types
+    return not concept_types.isdisjoint(the_type)
@@ -1,15 +1,23 @@
 import json
 import logging
 import requests
-import os
+from functools import lru_cache
 
 from text_analytics.abstract_nlp_service import NLPService
+from text_analytics.concurrency import nlp_request_slots
 from text_analytics.enhance import *
-from text_analytics.quickUMLS.semtype_lookup import lookup
+from text_analytics.insights import insight_constants
 from text_analytics.quickUMLS.semtype_lookup import get_semantic_type_list
+from text_analytics.quickUMLS.semtype_lookup import semTypes
 
 logger = logging.getLogger()
 
+# Number of distinct texts whose QuickUMLS responses are kept for each configuration
+quickumls_cache_size = 256
+
+# Semantic type codes that can produce an insight; concepts with none of them are dropped from the output
+relevant_semtypes = frozenset(code for code, name in semTypes.items() if name in insight_constants.CONCEPT_TYPES_ANY)
+
 class QuickUMLSService(NLPService):
     types_can_handle = {'AllergyIntolerance': enhance_allergy_intolerance_payload_to_fhir,
                         'Immunization': enhance_immunization_payload_to_fhir,
@@ -25,31 +33,38 @@ class QuickUMLSService(NLPService):
         self.quickUMLS_url = config_dict["config"]["endpoint"]
         self.jsonString = json_string
         self.config_name = config_dict["name"]
+        # Reuse connections to the QuickUMLS endpoint across requests
+        self.session = requests.Session()
+        # Cache responses by text, so repeated texts are not sent to QuickUMLS again
+        self._call_quickumls = lru_cache(maxsize=quickumls_cache_size)(self._call_quickumls)
 
+    # Errors are raised rather than returned, so only successful responses are cached
+    def _call_quickumls(self, text):
+        logger.info("Calling QUICKUMLS-%s", self.config_name)
+        with nlp_request_slots:
+            resp = self.session.post(self.quickUMLS_url, json={"text": text})
+        resp.raise_for_status()
+        concepts = resp.json()
+        if concepts is not None and not isinstance(concepts, list):
+            raise ValueError("QuickUMLS response is not a list of concepts: " + resp.text[:200])
+        return concepts
 
     def process(self, text):
         if type(text) is bytes:
-            request_body = {"text": text.decode('utf-8')}
-        else:
-            request_body = {"text": text}
-        logger.info("Calling QUICKUMLS-" + self.config_name)
-        resp = requests.post(self.quickUMLS_url, json=request_body)
-        concepts = json.loads(resp.text)
-        conceptsList = []
-        if concepts is not None:
-            for concept in concepts:
-                conceptsList.append(self.concept_to_dict(concept))
-        return {"concepts": conceptsList}
+            text = text.decode('utf-8')
+        concepts = self._call_quickumls(text)
+        return {"concepts": [self.concept_to_dict(concept) for concept in concepts or ()
+                             if not relevant_semtypes.isdisjoint(concept.get("semtypes") or ())]}
 
     @staticmethod
     def concept_to_dict(concept):
-        output = {"Structure": "Concept"}
-        output["generatingService"] = "quickUMLS"
-        output["coveredText"] = concept["ngram"] if "ngram" in concept else None
-        output["cui"] = concept["cui"] if "cui" in concept else None
-        output["begin"] = concept["start"] if "start" in concept else None
-        output["end"] = concept["end"] if "end" in concept else None
-        output["preferredName"] = concept["term"] if "term" in concept else None
-        output["type"] = get_semantic_type_list(concept["semtypes"]) if "semtypes" in concept and len(concept["semtypes"]) > 0 else None
-        output["negated"] = False
-        return output
+        semtypes = concept.get("semtypes")
+        return {"Structure": "Concept",
+                "generatingService": "quickUMLS",
+                "coveredText": concept.get("ngram"),
+                "cui": concept.get("cui"),
+                "begin": concept.get("start"),
+                "end": concept.get("end"),
+                "preferredName": concept.get("term"),
+                "type": get_semantic_type_list(semtypes) if semtypes else None,
+                "negated": False}
@@ -128,14 +128,8 @@ semTypes = {"T116": "umls.AminoAcidPeptideOrProtein",
 
 
 def lookup(semtype_code):
-    if semTypes.keys().__contains__(semtype_code):
-        return semTypes.get(semtype_code)
-    return semtype_code
+    return semTypes.get(semtype_code, semtype_code)
 
 def get_semantic_type_list(sem_types):
-    sem_type_list = []
-    for sem_type in sem_types:
-        sem_type_list.append(lookup(sem_type))
-
-    return sem_type_list
+    return [semTypes.get(sem_type, sem_type) for sem_type in sem_types]
     
@@ -0,0 +1,66 @@
+import pytest
+from fhir.resources.medicationstatement import MedicationStatement
+
+from text_analytics.acd.acd_service import ACDService
+
+
+def _medication(administration=None):
+    medication = {"drug": [{"name1": [{"drugSurfaceForm": "aspirin", "cui": "C0004057", "rxNormID": "1191"}]}]}
+    if administration is not None:
+        medication["administration"] = [administration]
+    return medication
+
+
+def _build_medication(medication):
+    med_statement = MedicationStatement.construct(status="unknown")
+    ACDService.build_medication(med_statement, medication, "insight-1")
+    return med_statement
+
+
+def test_dose_and_timing_added_from_administration():
+    med_statement = _build_medication(_medication({"dosageValue": "1,000 mg", "frequencyValue": "Q AM"}))
+
+    dose = med_statement.dosage[0]
+    dose_quantity = dose.doseAndRate[0].doseQuantity
+    assert dose_quantity.value == 1000
+    assert dose_quantity.unit == "mg"
+    assert dose.timing.code.coding[0].code == "AM"
+
+
+@pytest.mark.parametrize("dose_value, amount, units", [("5mg", 5, "mg"), ("0.5 ml", 0.5, "ml"), ("20", 20, None),
+                                                       (".5 mg", 0.5, "mg"), ("0.5 mg/kg", 0.5, "mg/kg"),
+                                                       ("325 mg tablet", 325, "mg tablet")])
+def test_dose_amount_and_units_parsed(dose_value, amount, units):
+    med_statement = _build_medication(_medication({"dosageValue": dose_value}))
+
+    dose_quantity = med_statement.dosage[0].doseAndRate[0].doseQuantity
+    assert dose_quantity.value == amount
+    assert dose_quantity.unit == units
+
+
+@pytest.mark.parametrize("dose_value", ["1/2 tablet", "5-10 mg", "2 x 5 mg", "1,5 mg", "one tablet"])
+def test_dose_not_a_single_amount_is_skipped(dose_value):
+    med_statement = _build_medication(_medication({"dosageValue": dose_value}))
+
+    assert med_statement.dosage is None
+
+
+def test_timing_kept_when_dose_is_skipped():
+    med_statement = _build_medication(_medication({"dosageValue": "1/2 tablet", "frequencyValue": "Q PM"}))
+
+    dose = med_statement.dosage[0]
+    assert dose.doseAndRate is None
+    assert dose.timing.code.coding[0].code == "PM"
+
+
+def test_no_dosage_without_dose_or_timing():
+    med_statement = _build_medication(_medication({"frequencyValue": "twice a day"}))
+
+    assert med_statement.dosage is None
+
+
+def test_no_dosage_without_administration():
+    med_statement = _build_medication(_medication())
+
+    assert med_statement.dosage is None
+    assert med_statement.medicationCodeableConcept.text == "aspirin"
@@ -0,0 +1,76 @@
+from fhir.resources.codeableconcept import CodeableConcept
+
+from text_analytics.insights import insight_constants
+from text_analytics.utils import fhir_object_utils
+
+INSIGHT_SYSTEM = insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM
+
+
+def _insight_ids(coding):
+    if coding.extension is None:
+        return []
+    return [ext.valueIdentifier.value for ext in coding.extension[0].extension
+            if ext.url == insight_constants.INSIGHT_RESULT_ID_URL]
+
+
+def test_insights_share_derived_coding_next_to_existing_coding():
+    existing = fhir_object_utils.create_coding(insight_constants.SNOMED_URL, "38341003")
+    codeable_concept = CodeableConcept.construct(coding=[existing])
+    coding_index = fhir_object_utils.index_codings(codeable_concept)
+
+    fhir_object_utils.create_coding_entries(codeable_concept, insight_constants.SNOMED_URL, "38341003",
+                                            "insight-1", INSIGHT_SYSTEM, coding_index)
+    fhir_object_utils.create_coding_entries(codeable_concept, insight_constants.SNOMED_URL, "38341003",
+                                            "insight-2", INSIGHT_SYSTEM, coding_index)
+
+    # the existing coding is left alone, and one derived coding holds both insights
+    assert len(codeable_concept.coding) == 2
+    assert codeable_concept.coding[0] is existing
+    assert _insight_ids(existing) == []
+    assert _insight_ids(codeable_concept.coding[1]) == ["insight-1", "insight-2"]
+
+
+def test_add_codings_reuses_derived_coding_next_to_existing_coding():
+    # add_codings indexes the codeable concept again on every call, as the allergy, immunization
+    # and condition builders do for each insight
+    existing = fhir_object_utils.create_coding(insight_constants.SNOMED_URL, "38341003")
+    codeable_concept = CodeableConcept.construct(coding=[existing])
+    concept = {"snomedConceptId": "38341003"}
+
+    fhir_object_utils.add_codings(concept, codeable_concept, "insight-1", INSIGHT_SYSTEM)
+    fhir_object_utils.add_codings(concept, codeable_concept, "insight-2", INSIGHT_SYSTEM)
+
+    derived = [coding for coding in codeable_concept.coding if coding.extension is not None]
+    assert len(codeable_concept.coding) == 2
+    assert len(derived) == 1
+    assert _insight_ids(derived[0]) == ["insight-1", "insight-2"]
+
+
+def test_coding_entries_strip_whitespace_and_skip_empty_codes():
+    codeable_concept = CodeableConcept.construct(coding=[])
+
+    fhir_object_utils.create_coding_entries(codeable_concept, insight_constants.ICD10_URL, " I10, E11.9 ,,",
+                                            "insight-1", INSIGHT_SYSTEM)
+
+    assert [coding.code for coding in codeable_concept.coding] == ["I10", "E11.9"]
+
+
+def test_single_coding_entry_is_stripped():
+    codeable_concept = CodeableConcept.construct(coding=[])
+
+    fhir_object_utils.create_coding_entries(codeable_concept, insight_constants.ICD10_URL, " I10 ",
+                                            "insight-1", INSIGHT_SYSTEM)
+    fhir_object_utils.create_coding_entries(codeable_concept, insight_constants.ICD10_URL, "  ",
+                                            "insight-2", INSIGHT_SYSTEM)
+
+    assert [coding.code for coding in codeable_concept.coding] == ["I10"]
+
+
+def test_insight_detail_built_once_on_first_use():
+    get_insight_detail = fhir_object_utils.insight_detail_builder({"concepts": []})
+
+    insight_detail = get_insight_detail()
+
+    assert get_insight_detail() is insight_detail
+    assert insight_detail.url == insight_constants.INSIGHT_EVIDENCE_DETAIL_URL
+    assert insight_detail.valueAttachment.data == fhir_object_utils.encode_insight_detail({"concepts": []})
@@ -1,5 +1,6 @@
 import base64
 import json
+from functools import lru_cache
 
 from fhir.resources.attachment import Attachment
 from fhir.resources.bundle import Bundle
@@ -23,32 +24,35 @@ def create_coding(system, code, display=None):
 
 
 def create_confidence(name, value):
-    confidence = Extension.construct()
-    confidence.url = insight_constants.INSIGHT_CONFIDENCE_URL
     confidence_name = Extension.construct()
     confidence_name.url = insight_constants.INSIGHT_CONFIDENCE_NAME_URL
     confidence_name.valueString = name
     confidence_score = Extension.construct()
     confidence_score.url = insight_constants.INSIGHT_CONFIDENCE_SCORE_URL
     confidence_score.valueString = value
-    confidence.extension = [confidence_name]
-    confidence.extension.append(confidence_score)
+    confidence = Extension.construct(url=insight_constants.INSIGHT_CONFIDENCE_URL,
+                                     extension=[confidence_name, confidence_score])
     return confidence
 
 
-# Adds insight reference extension for use within the actual resource
-# This adds the classification and insight id to an extension that can be
-# attached to a field like MedicationStatement.dosage or CodeableConcept.coding
-def create_insight_reference(insight_id, insight_system):
-    object_ext = Extension.construct()
-    object_ext.url = insight_constants.INSIGHT_REFERENCE_URL
-
+# The "derived" classification is the same for every insight reference and is never modified,
+# so it is built once and shared by all of them
+@lru_cache(maxsize=None)
+def _derived_classification_extension():
     classification_ext = Extension.construct()
     classification_ext.url = insight_constants.INSIGHT_CLASSIFICATION_URL
     classification_value = Coding.construct()
     classification_value.system = insight_constants.INSIGHT_CLASSIFICATION_SYSTEM
     classification_value.code = insight_constants.CLASSIFICATION_DERIVED
     classification_ext.valueCoding = classification_value
+    return classification_ext
+
+
+# Adds insight reference extension for use within the actual resource
+# This adds the classification and insight id to an extension that can be
+# attached to a field like MedicationStatement.dosage or CodeableConcept.coding
+def create_insight_reference(insight_id, insight_system):
+    classification_ext = _derived_classification_extension()
 
     insight_id_ext = Extension.construct()
     insight_id_ext.url = insight_constants.INSIGHT_RESULT_ID_URL
@@ -57,8 +61,8 @@ def create_insight_reference(insight_id, insight_system):
     insight_identifier.value = insight_id
     insight_id_ext.valueIdentifier = insight_identifier
 
-    object_ext.extension = [classification_ext]
-    object_ext.extension.append(insight_id_ext)
+    object_ext = Extension.construct(url=insight_constants.INSIGHT_REFERENCE_URL,
+                                     extension=[classification_ext, insight_id_ext])
 
     return object_ext
 
@@ -83,23 +87,22 @@ def add_insight_id(object_extension, insight_id, insight_system):
     object_extension.append(insight_id_ext)
 
 
+# Bundles only use a few (method, url) pairs, such as POST to Condition or MedicationStatement.
+# The requests are never modified, so one request per pair is built and shared by the entries.
+@lru_cache(maxsize=256)
+def _bundle_entry_request(method, url):
+    return BundleEntryRequest.construct(method=method, url=url)
+
+
 # fhir_resource_action --> list of resource(s) with their request type ('POST' or 'PUT') and url
-#                    example: [[resource1, 'POST', 'url1'], [resource2, 'PUT', 'url2']]
+#                    example: [(resource1, 'POST', 'url1'), (resource2, 'PUT', 'url2')]
 def create_transaction_bundle(fhir_resource_action):
-    bundle = Bundle.construct()
-    bundle.type = "transaction"
-    bundle.entry = []
-
-    for resource, request_type, url in fhir_resource_action:
-        bundle_entry = BundleEntry.construct()
-        bundle_entry.resource = resource
-        json = {
-            "method": request_type,
-            "url": url
-        }
-        request = BundleEntryRequest.parse_obj(json)
-        bundle_entry.request = request
-        bundle.entry.append(bundle_entry)
+    # Entries are built in a local list and passed to construct(), so neither the list
+    # nor the resources in it go through assignment validation
+    entries = [BundleEntry.construct(resource=resource,
+                                     request=_bundle_entry_request(request_type, url))
+               for resource, request_type, url in fhir_resource_action]
+    bundle = Bundle.construct(type="transaction", entry=entries)
 
     return bundle
 
@@ -107,18 +110,16 @@ def create_transaction_bundle(fhir_resource_action):
 # Adds process meta extensions common across all insights,
 # Does not check if these extensions already exist.
 def _add_resource_meta(meta):
-    result_extension = Extension.construct()
-    result_extension.url = insight_constants.INSIGHT_RESULT_URL
-
     process_name_extension = Extension.construct()
     process_name_extension.url = insight_constants.PROCESS_NAME_URL
     process_name_extension.valueString = insight_constants.PROCESS_NAME
-    result_extension.extension = [process_name_extension]
 
     process_version_extension = Extension.construct()
     process_version_extension.url = insight_constants.PROCESS_VERSION_URL
     process_version_extension.valueString = insight_constants.PROCESS_VERSION
-    result_extension.extension.append(process_version_extension)
+
+    result_extension = Extension.construct(url=insight_constants.INSIGHT_RESULT_URL,
+                                           extension=[process_name_extension, process_version_extension])
 
     meta.extension = [result_extension]
 
@@ -168,8 +169,10 @@ def add_resource_meta_structured(nlp, resource):
     result_extension.extension.append(process_type_extension)
 
 
-def create_derived_resource_extension(resource):
-    # add extension indicating resource was derived (created from insights)
+# Builds the extension indicating a resource was derived (created from insights).
+# The extension is never modified once built, so it is built once and shared by every derived resource.
+@lru_cache(maxsize=None)
+def build_derived_resource_extension():
     resource_ext = Extension.construct()
     resource_ext.url = insight_constants.INSIGHT_REFERENCE_URL
     resource_ext_nested = Extension.construct()
@@ -179,25 +182,25 @@ def create_derived_resource_extension(resource):
     classification.system = insight_constants.INSIGHT_CLASSIFICATION_URL
     classification.code = insight_constants.CLASSIFICATION_DERIVED
     resource_ext_nested.valueCoding = classification
-    resource.extension = [resource_ext]
+    return resource_ext
+
+
+def create_derived_resource_extension(resource):
+    # add extension indicating resource was derived (created from insights)
+    resource.extension = [build_derived_resource_extension()]
 
 
 def create_insight_span_extension(concept):
-    offset_begin = Extension.construct()
-    offset_begin.url = insight_constants.INSIGHT_SPAN_OFFSET_BEGIN_URL
-    offset_begin.valueInteger = concept.get('begin')
-    offset_end = Extension.construct()
-    offset_end.url = insight_constants.INSIGHT_SPAN_OFFSET_END_URL
-    offset_end.valueInteger = concept.get('end')
-    covered_text = Extension.construct()
-    covered_text.url = insight_constants.INSIGHT_SPAN_COVERED_TEXT_URL
-    covered_text.valueString = concept.get('coveredText')
-
-    insight_span = Extension.construct()
-    insight_span.url = insight_constants.INSIGHT_SPAN_URL
-    insight_span.extension = [covered_text]
-    insight_span.extension.append(offset_begin)
-    insight_span.extension.append(offset_end)
+    # Fields are passed to construct() rather than assigned, so the per-insight span skips assignment validation
+    offset_begin = Extension.construct(url=insight_constants.INSIGHT_SPAN_OFFSET_BEGIN_URL,
+                                       valueInteger=concept.get('begin'))
+    offset_end = Extension.construct(url=insight_constants.INSIGHT_SPAN_OFFSET_END_URL,
+                                     valueInteger=concept.get('end'))
+    covered_text = Extension.construct(url=insight_constants.INSIGHT_SPAN_COVERED_TEXT_URL,
+                                       valueString=concept.get('coveredText'))
+
+    insight_span = Extension.construct(url=insight_constants.INSIGHT_SPAN_URL,
+                                       extension=[covered_text, offset_begin, offset_end])
 
     return insight_span
 
@@ -212,151 +215,177 @@ def create_insight_extension(insight_id_string, insight_system):
     return insight_id_ext
 
 
-def create_insight_detail_extension(nlp_output):
+# Encodes the full nlp output for an insight detail extension.
+# Every insight from the same nlp output stores the same data, so callers should encode once per output.
+def encode_insight_detail(nlp_output):
     nlp_dict = nlp_output # .to_dict()
     nlp_dict_string = json.dumps(nlp_dict)  # get the string
     nlp_as_bytes = nlp_dict_string.encode('utf-8')  # convert to bytes including utf8 content
     nlp_base64_encoded_bytes = base64.b64encode(nlp_as_bytes)  # encode to base64
     nlp_base64_ascii_string = nlp_base64_encoded_bytes.decode("ascii")  # convert base64 bytes to ascii characters
+    return nlp_base64_ascii_string
+
+
+# nlp_output_data --> nlp output as returned by encode_insight_detail
+def create_insight_detail_extension(nlp_output_data):
     insight_detail = Extension.construct()
     insight_detail.url = insight_constants.INSIGHT_EVIDENCE_DETAIL_URL
     attachment = Attachment.construct()
     attachment.contentType = "json"
-    attachment.data = nlp_base64_ascii_string  # data is an ascii string of encoded data
+    attachment.data = nlp_output_data  # data is an ascii string of encoded data
     insight_detail.valueAttachment = attachment
     return insight_detail
 
 
+def _is_derived_coding(coding):
+    return coding.extension is not None and coding.extension[0].url == insight_constants.INSIGHT_REFERENCE_URL
+
+
+# Returns a function that builds the insight detail extension for the nlp output on its first call,
+# and returns the same extension on later calls. Outputs that produce no insights are never encoded.
+def insight_detail_builder(nlp_output):
+    @lru_cache(maxsize=None)
+    def get_insight_detail():
+        return create_insight_detail_extension(encode_insight_detail(nlp_output))
+    return get_insight_detail
+
+
+def index_codings(codeable_concept):
+    '''
+    Returns the codings of the codeable_concept in a dict keyed by (system, code),
+    so that existing codes can be found without scanning the coding list.
+    When a code has both a source coding and a derived coding, the derived coding is kept,
+    so that later insights add their ids to it instead of creating another derived coding.
+    '''
+    coding_index = {}
+    for coding in codeable_concept.coding:
+        key = (coding.system, coding.code)
+        indexed = coding_index.get(key)
+        if indexed is None or (not _is_derived_coding(indexed) and _is_derived_coding(coding)):
+            coding_index[key] = coding
+    return coding_index
+
+
+# Adds the insight id to the existing derived coding entry for the code,
+# or creates a new derived coding entry and adds it to the codeable_concept and index.
+def _add_coding_entry(codeable_concept, coding_index, code_url, code_id, insight_id, insight_system, display=None):
+    code_entry = coding_index.get((code_url, code_id))
+    if code_entry is not None and _is_derived_coding(code_entry):
+        # there is already a derived extension
+        add_insight_id(code_entry.extension[0].extension, insight_id, insight_system)
+    else:
+        # the Concept exists, but no derived extension
+        coding = create_coding_system_entry(code_url, code_id, insight_id, insight_system)
+        if display is not None:
+            coding.display = display
+        codeable_concept.coding.append(coding)
+        coding_index[(code_url, code_id)] = coding
+
+
 # ACD will often return multiple codes from one system in a comma delimited list
 # Split the list, then create a separate coding system entry for each one
-def create_coding_entries(codeable_concept, code_url, code_ids, insight_id, insight_system):
-    ids = code_ids.split(",")
-    for id in ids:
-        code_entry = find_codable_concept(codeable_concept, id, code_url)
-        if code_entry is not None and code_entry.extension is not None and code_entry.extension[
-            0].url == insight_constants.INSIGHT_REFERENCE_URL:
-            # there is already a derived extension
-            add_insight_id(code_entry.extension[0].extension, insight_id, insight_system)
-        else:
-            # the Concept exists, but no derived extension
-            coding = create_coding_system_entry(code_url, id, insight_id, insight_system)
-            codeable_concept.coding.append(coding)
+# Whitespace around the codes is removed, so "1, 2" does not create a separate code " 2"
+def create_coding_entries(codeable_concept, code_url, code_ids, insight_id, insight_system, coding_index=None):
+    if coding_index is None:
+        coding_index = index_codings(codeable_concept)
+    if "," not in code_ids:
+        # Most code fields hold a single value, so skip splitting them into a list
+        code_ids = code_ids.strip()
+        if code_ids:
+            _add_coding_entry(codeable_concept, coding_index, code_url, code_ids, insight_id, insight_system)
+        return
+    for id in code_ids.split(","):
+        id = id.strip()
+        if id:
+            _add_coding_entry(codeable_concept, coding_index, code_url, id, insight_id, insight_system)
+
+
+# Concept fields holding comma-delimited codes, and the code system of each
+_CODING_FIELDS = (("snomedConceptId", insight_constants.SNOMED_URL),
+                  ("nciCode", insight_constants.NCI_URL),
+                  ("loincId", insight_constants.LOINC_URL),
+                  ("meshId", insight_constants.MESH_URL),
+                  ("icd9Code", insight_constants.ICD9_URL),
+                  ("icd10Code", insight_constants.ICD10_URL),
+                  ("rxNormId", insight_constants.RXNORM_URL))
 
 
 def add_codings(concept, codeable_concept, insight_id, insight_system):
+    coding_index = index_codings(codeable_concept)
     if 'cui' in concept:
         # For CUIs, we do not handle comma-delimited values (have not seen that we ever have more than one value)
         # We use the preferred name from UMLS for the display text
-        code_entry = find_codable_concept(codeable_concept, concept['cui'], insight_constants.UMLS_URL)
-        if code_entry is not None and code_entry.extension is not None and code_entry.extension[
-            0].url == insight_constants.INSIGHT_REFERENCE_URL:
-            # there is already a derived extension
-            add_insight_id(code_entry.extension[0].extension, insight_id, insight_system)
-        else:
-            # the Concept exists, but no derived extension
-            coding = create_coding_system_entry(insight_constants.UMLS_URL, concept['cui'], insight_id, insight_system)
-            coding.display = concept["preferredName"]
-            codeable_concept.coding.append(coding)
-    if "snomedConceptId" in concept:
-        create_coding_entries(codeable_concept, insight_constants.SNOMED_URL, concept["snomedConceptId"], insight_id,
-                              insight_system)
-    if "nciCode" in concept:
-        create_coding_entries(codeable_concept, insight_constants.NCI_URL, concept["nciCode"], insight_id,
-                              insight_system)
-    if "loincId" in concept:
-        create_coding_entries(codeable_concept, insight_constants.LOINC_URL, concept["loincId"], insight_id,
-                              insight_system)
-    if "meshId" in concept:
-        create_coding_entries(codeable_concept, insight_constants.MESH_URL, concept["meshId"], insight_id,
-                              insight_system)
-    if "icd9Code" in concept:
-        create_coding_entries(codeable_concept, insight_constants.ICD9_URL, concept["icd9Code"], insight_id,
-                              insight_system)
-    if "icd10Code" in concept:
-        create_coding_entries(codeable_concept, insight_constants.ICD10_URL, concept["icd10Code"], insight_id,
-                              insight_system)
-    if "rxNormId" in concept:
-        create_coding_entries(codeable_concept, insight_constants.RXNORM_URL, concept["rxNormId"], insight_id,
-                              insight_system)
-
-
-def add_codings_drug(drug, drug_name, codeable_concept, insight_id, insight_system):
+        _add_coding_entry(codeable_concept, coding_index, insight_constants.UMLS_URL, concept['cui'], insight_id,
+                          insight_system, concept["preferredName"])
+    for field, code_url in _CODING_FIELDS:
+        code_ids = concept.get(field)
+        if code_ids is not None:
+            create_coding_entries(codeable_concept, code_url, code_ids, insight_id, insight_system, coding_index)
+
+
+# coding_index may be passed in when the caller keeps the index of codeable_concept between calls
+def add_codings_drug(drug, drug_name, codeable_concept, insight_id, insight_system, coding_index=None):
+    if coding_index is None:
+        coding_index = index_codings(codeable_concept)
     if drug.get("cui") is not None:
         # For CUIs, we do not handle comma-delimited values (have not seen that we ever have more than one value)
         # We use the preferred name from UMLS for the display text
-        code_entry = find_codable_concept(codeable_concept, drug.get("cui"), insight_constants.UMLS_URL)
-        if code_entry is not None and code_entry.extension is not None and code_entry.extension[
-            0].url == insight_constants.INSIGHT_REFERENCE_URL:
-            # there is already a derived extension
-            add_insight_id(code_entry.extension[0].extension, insight_id, insight_system)
-        else:
-            # the Concept exists, but no derived extension
-            coding = create_coding_system_entry(insight_constants.UMLS_URL, drug.get("cui"), insight_id,
-                                                insight_system)
-
-            coding.display = drug_name
-            codeable_concept.coding.append(coding)
+        _add_coding_entry(codeable_concept, coding_index, insight_constants.UMLS_URL, drug.get("cui"), insight_id,
+                          insight_system, drug_name)
     if drug.get("rxNormID") is not None:
         create_coding_entries(codeable_concept, insight_constants.RXNORM_URL, drug.get("rxNormID"), insight_id,
-                              insight_system)
+                              insight_system, coding_index)
 
 
-
-
-
-def find_codable_concept(codeable_concept, id, system):
-    '''
-    Looks through the array of the codeable_concept for an entry matching the id and system.
-    Returns the entry if found, or None if not found.
-    '''
-    for entry in codeable_concept.coding:
-        if entry.system == system and entry.code == id:
-            return entry
-    return None
+def _append_confidence(insight_ext, name, value):
+    if value is not None:
+        insight_ext.append(create_confidence(name, value))
 
 
 def add_diagnosis_confidences(insight_ext, insight_model_data):
-    if insight_model_data['diagnosis'] is not None:
-        if insight_model_data['diagnosis']['usage'] is not None:
-            if 'explicitScore' in insight_model_data['diagnosis']['usage'] and insight_model_data['diagnosis']['usage']['explicitScore'] is not None:
-                confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_EXPLICIT,
-                                               insight_model_data['diagnosis']['usage']['explicitScore'])
-                insight_ext.append(confidence)
-            if 'patientReportedScore' in insight_model_data['diagnosis']['usage'] and insight_model_data['diagnosis']['usage']['patientReportedScore'] is not None:
-                confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_PATIENT_REPORTED,
-                                               insight_model_data['diagnosis']['usage']['patientReportedScore'])
-                insight_ext.append(confidence)
-            if 'discussedScore' in insight_model_data['diagnosis']['usage'] and insight_model_data['diagnosis']['usage']['discussedScore'] is not None:
-                confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_DISCUSSED,
-                                               insight_model_data['diagnosis']['usage']['discussedScore'])
-                insight_ext.append(confidence)
-            if 'familyHistoryScore' in insight_model_data['diagnosis']['usage'] and insight_model_data['diagnosis']['usage']['familyHistoryScore'] is not None:
-                confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_FAMILY_HISTORY,
-                                               insight_model_data['diagnosis']['familyHistoryScore'])
-                insight_ext.append(confidence)
-            if 'suspectedScore' in insight_model_data['diagnosis']['usage'] and insight_model_data['diagnosis']['usage']['suspectedScore'] is not None:
-                confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_SUSPECTED,
-                                               insight_model_data['diagnosis']['suspectedScore'])
-                insight_ext.append(confidence)
+    diagnosis = insight_model_data.get('diagnosis')
+    if diagnosis is None:
+        return
+    usage = diagnosis.get('usage')
+    if usage is not None:
+        _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_EXPLICIT, usage.get('explicitScore'))
+        _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_PATIENT_REPORTED, usage.get('patientReportedScore'))
+        _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_DISCUSSED, usage.get('discussedScore'))
+    # family history and suspected scores are not usage scores, they are directly under diagnosis
+    _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_FAMILY_HISTORY, diagnosis.get('familyHistoryScore'))
+    _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_SUSPECTED, diagnosis.get('suspectedScore'))
 
 
 def add_medication_confidences(insight_ext, insight_model_data):
     # Medication has 5 types of confidence scores
     # For alpha only pulling medication.usage scores
     # Not using startedEvent scores, stoppedEvent scores, doseChangedEvent scores, adversetEvent scores
-    confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_MEDICATION_TAKEN,
-                                   insight_model_data['medication']['usage']['takenScore'])
-    insight_ext.append(confidence)
-
-    confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_MEDICATION_CONSIDERING,
-                                   insight_model_data['medication']['usage']['consideringScore'])
-    insight_ext.append(confidence)
-    confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_MEDICATION_DISCUSSED,
-                                   insight_model_data['medication']['usage']['discussedScore'])
-    insight_ext.append(confidence)
-    confidence = create_confidence(insight_constants.CONFIDENCE_SCORE_MEDICATION_MEASUREMENT,
-                                   insight_model_data['medication']['usage']['labMeasurementScore'])
-    insight_ext.append(confidence)
+    medication = insight_model_data.get('medication')
+    usage = medication.get('usage') if medication is not None else None
+    if usage is None:
+        return
+    _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_MEDICATION_TAKEN, usage.get('takenScore'))
+    _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_MEDICATION_CONSIDERING, usage.get('consideringScore'))
+    _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_MEDICATION_DISCUSSED, usage.get('discussedScore'))
+    _append_confidence(insight_ext, insight_constants.CONFIDENCE_SCORE_MEDICATION_MEASUREMENT, usage.get('labMeasurementScore'))
+
+
+# Attachments with these content types hold binary data that cannot be decoded as text
+_BINARY_CONTENT_TYPES = ('application/pdf', 'image/')
+
+
+def _get_attachment_text(attachment):
+    '''
+    Returns the attachment data as a string, decoded.
+    Returns None if there is no data, or the content type is known to be binary.
+    '''
+    if attachment is None or not attachment.data:
+        return None
+    if attachment.contentType and attachment.contentType.startswith(_BINARY_CONTENT_TYPES):
+        return None
+    byte_text = base64.b64decode(attachment.data)
+    return byte_text.decode('utf8')  # This removes the b'..' around the text string
+
 
 def get_diagnostic_report_data(diagnostic_report):
     '''
@@ -364,11 +393,8 @@ def get_diagnostic_report_data(diagnostic_report):
     Parameters:
       diagnostic_report - fhir.resources.diagnosticreport object where the text will be retrieved
     '''
-    if diagnostic_report.presentedForm and diagnostic_report.presentedForm[0] and diagnostic_report.presentedForm[0].data:
-        encoded_data = diagnostic_report.presentedForm[0].data
-        byte_text = base64.b64decode(encoded_data)
-        text = byte_text.decode('utf8')  # This removes the b'..' around the text string
-        return text
+    if diagnostic_report.presentedForm:
+        return _get_attachment_text(diagnostic_report.presentedForm[0])
     return None
 
 def get_document_reference_data(document_reference):
@@ -377,9 +403,6 @@ def get_document_reference_data(document_reference):
     Parameters:
       document_reference - fhir.resources.documentreference object where the text will be retrieved
     '''
-    if document_reference.content and document_reference.content[0] and document_reference.content[0].attachment and document_reference.content[0].attachment.data:
-        encoded_data = document_reference.content[0].attachment.data
-        byte_text = base64.b64decode(encoded_data)
-        text = byte_text.decode('utf8')  # This removes the b'..' around the text string
-        return text
+    if document_reference.content and document_reference.content[0]:
+        return _get_attachment_text(document_reference.content[0].attachment)
     return None